@@ -10,12 +10,14 @@
 """
 
 import pandas as pd
+import numpy as np
 import csv
 import json
 import os
 import re
 import datetime
 import time
+from daily_index import write_daily_index
 
 # ---- Declares global constant ----
 DTYPE_DICT = {
@@ -23,15 +25,18 @@ DTYPE_DICT = {
       'AccountOwnerId': 'str', 'AccountName': 'str', 'SubscriptionName': 'str', 'Date': 'str', 'MeterCategory': 'str', 'MeterSubCategory': 'str',
       'MeterName': 'str', 'Cost': 'float64', 'UnitPrice': 'float64', 'BillingCurrency': 'str', 'ResourceLocation': 'str', 'ConsumedService': 'str',
       'ResourceName': 'str', 'AdditionalInfo': 'str', 'Tags': 'str', 'CostCenter': 'str', 'ResourceGroup': 'str', 'ReservationName': 'str',
-      'ProductOrderName': 'str', 'Term': 'str', 'ChargeType': 'str', 'PayGPrice': 'float64', 'PricingModel': 'str'
+      'ProductOrderName': 'str', 'Term': 'str', 'ChargeType': 'str', 'PayGPrice': 'float64', 'PricingModel': 'str',
+      'Quantity': 'float64', 'ReservationId': 'str', 'UnitOfMeasure': 'str'
   }
 COLUMNS = [
       'BillingAccountId', 'BillingAccountName', 'BillingPeriodEndDate', 'BillingProfileId', 'BillingProfileName',
       'AccountOwnerId', 'AccountName', 'SubscriptionName', 'Date', 'MeterCategory', 'MeterSubCategory',
       'MeterName', 'Cost', 'UnitPrice',	'BillingCurrency', 'ResourceLocation', 'ConsumedService',
       'ResourceName', 'AdditionalInfo', 'Tags', 'CostCenter', 'ResourceGroup', 'ReservationName',
-      'ProductOrderName', 'Term', 'ChargeType', 'PayGPrice', 'PricingModel'
+      'ProductOrderName', 'Term', 'ChargeType', 'PayGPrice', 'PricingModel', 'Quantity',
+      'ReservationId', 'UnitOfMeasure'
   ]
+RESERVATION_KEYS = ['ReservationId', 'ReservationName']
 JSON_FILE = 'Set-AzBillingSynthesis.json'
 GROUPING = False
 
@@ -247,6 +252,208 @@ def get_reservation_type(product):
       new_product = reservation_type.group(1).strip()
   return new_product
 
+def set_utilization(df):
+  """
+    Calculates the utilization rate and the amortized cost of reservations
+    Input:
+      - df: dataframe with columns UsedHours, UnusedHours, UsedCost and UnusedCost
+    Output:
+      - df: dataframe with new columns Utilization (in %, empty if the reservation is not metered in hours)
+        and AmortizedCost
+  """
+  total_hours = df['UsedHours'] + df['UnusedHours']
+  df['Utilization'] = (df['UsedHours'] / total_hours.where(total_hours > 0) * 100).round(2)
+  df['AmortizedCost'] = df['UsedCost'] + df['UnusedCost']
+  return df
+
+def get_reservation_rows(df, month):
+  """
+    Extracts the columns needed for reservations from the rows of the month
+    consuming a reservation (Usage) or with unused hours of reservations (UnusedReservation)
+    Input:
+      - df: dataframe with ProductOrderName already reduced to the type of reservation
+      - month: month to keep with format yyyymm
+    Output:
+      - pandas dataframe with the rows of reservations
+  """
+  global RESERVATION_KEYS
+
+  filter = (((df['Date'].dt.year * 100 + df['Date'].dt.month) == month) & df['ReservationName'].notna()
+    & df['ChargeType'].isin(['Usage', 'UnusedReservation']))
+  return df.loc[filter, RESERVATION_KEYS + [
+    'ProductOrderName', 'Term', 'Date', 'SubscriptionName', 'ResourceGroup', 'ResourceName',
+    'ChargeType', 'Quantity', 'UnitOfMeasure', 'Cost', 'AdditionalInfo']]
+
+def is_amortized(df_reservation):
+  """
+    Checks if the file comes from the amortized cost dataset.
+    In the actual cost dataset, the rows consuming a reservation have a cost of 0,
+    there is no UnusedReservation row and the cost of reservations is in the Purchase rows
+    Input:
+      - df_reservation: dataframe returned by get_reservation_rows
+    Output:
+      - True if there are UnusedReservation rows or reservation usage with a cost
+  """
+  filter = (df_reservation['ChargeType'] == 'UnusedReservation') | (df_reservation['Cost'] != 0)
+  return bool(filter.any())
+
+def get_reservation_usage(df_reservation):
+  """
+    Groups in one pass the rows of reservations by reservation, day and resource.
+    Hours are counted only for reservations metered in hours (UnitOfMeasure), and the hours
+    consumed by resources are normalized with the RINormalizationRatio of AdditionalInfo
+    (instance size flexibility). The costs are amortized only if the file comes
+    from the amortized cost dataset (see is_amortized)
+    Input:
+      - df_reservation: dataframe returned by get_reservation_rows
+    Output:
+      - pandas dataframe with used and unused hours and cost per reservation, day and resource
+  """
+  global RESERVATION_KEYS
+
+  unused = df_reservation['ChargeType'] == 'UnusedReservation'
+  # Number of hours of the unit of measure ('1 Hour', '10 Hours'), empty if not metered in hours
+  unit_hours = pd.to_numeric(df_reservation['UnitOfMeasure'].str.extract(r'^\s*(\d*)\s*Hours?\s*$', expand=False).replace('', '1'))
+  ratio = pd.to_numeric(df_reservation['AdditionalInfo'].str.extract(r'"RINormalizationRatio":\s*"?([\d.]+)', expand=False)).fillna(1)
+  hours = (df_reservation['Quantity'] * unit_hours * ratio.where(~unused, 1)).fillna(0)
+  df_reservation = df_reservation.assign(
+    UsedHours = hours.where(~unused, 0),
+    UnusedHours = hours.where(unused, 0),
+    UsedCost = df_reservation['Cost'].where(~unused, 0),
+    UnusedCost = df_reservation['Cost'].where(unused, 0)
+  )
+  return df_reservation.groupby(RESERVATION_KEYS + ['Date', 'SubscriptionName', 'ResourceGroup', 'ResourceName'],
+    as_index=False, dropna=False).agg(
+      ReservationType = ('ProductOrderName', 'first'), Term = ('Term', 'first'),
+      UsedHours = ('UsedHours', 'sum'), UnusedHours = ('UnusedHours', 'sum'),
+      UsedCost = ('UsedCost', 'sum'), UnusedCost = ('UnusedCost', 'sum')
+  )
+
+def reservation_daily(df_usage):
+  """
+    Calculates the daily utilization, unused hours and amortized cost per reservation
+    Input:
+      - df_usage: dataframe returned by get_reservation_usage
+    Output:
+      - pandas dataframe with one row per reservation and per day
+  """
+  global RESERVATION_KEYS
+
+  df = df_usage.groupby(RESERVATION_KEYS + ['Date'], as_index=False, dropna=False).agg(
+    ReservationType = ('ReservationType', 'first'), Term = ('Term', 'first'),
+    UsedHours = ('UsedHours', 'sum'), UnusedHours = ('UnusedHours', 'sum'),
+    UsedCost = ('UsedCost', 'sum'), UnusedCost = ('UnusedCost', 'sum')
+  )
+  return set_utilization(df)
+
+def reservation_monthly(df_daily):
+  """
+    Calculates the monthly utilization, unused hours and amortized cost per reservation
+    Input:
+      - df_daily: dataframe returned by reservation_daily
+    Output:
+      - pandas dataframe with one row per reservation and per month (format yyyymm)
+  """
+  global RESERVATION_KEYS
+
+  df = df_daily.assign(Month = df_daily['Date'].dt.strftime('%Y%m')).groupby(
+    RESERVATION_KEYS + ['Month'], as_index=False, dropna=False).agg(
+      ReservationType = ('ReservationType', 'first'), Term = ('Term', 'first'),
+      UsedHours = ('UsedHours', 'sum'), UnusedHours = ('UnusedHours', 'sum'),
+      UsedCost = ('UsedCost', 'sum'), UnusedCost = ('UnusedCost', 'sum')
+  )
+  return set_utilization(df)
+
+def reservation_resources(df_usage, df_daily):
+  """
+    Attributes the amortized cost of reservations to the consuming resources.
+    The unused cost of a reservation is shared between its resources in proportion
+    of the hours they consumed, or of their cost if the reservation is not metered in hours.
+    A reservation without usage is kept in a row without resource holding all its unused cost
+    Input:
+      - df_usage: dataframe returned by get_reservation_usage
+      - df_daily: dataframe returned by reservation_daily
+    Output:
+      - pandas dataframe with one row per reservation and per resource
+  """
+  global RESERVATION_KEYS
+
+  # UnusedReservation rows have no resource
+  df = df_usage.loc[df_usage['ResourceName'].notna()].groupby(
+    RESERVATION_KEYS + ['SubscriptionName', 'ResourceGroup', 'ResourceName'], as_index=False, dropna=False).agg(
+      UsedHours = ('UsedHours', 'sum'), UsedCost = ('UsedCost', 'sum')
+  )
+  df_total = df_daily.groupby(RESERVATION_KEYS, as_index=False, dropna=False).agg(
+    ReservationType = ('ReservationType', 'first'), ReservationUsedHours = ('UsedHours', 'sum'),
+    ReservationUsedCost = ('UsedCost', 'sum'), ReservationUnusedCost = ('UnusedCost', 'sum')
+  )
+  # right join to keep the reservations without usage
+  df = df.merge(df_total, on=RESERVATION_KEYS, how='right')
+  df[['UsedHours', 'UsedCost']] = df[['UsedHours', 'UsedCost']].fillna(0)
+  # share of each resource: hours, otherwise cost, otherwise equal parts
+  rows = df.groupby(RESERVATION_KEYS, dropna=False)['UsedHours'].transform('size')
+  share = np.where(df['ReservationUsedHours'] > 0,
+    df['UsedHours'] / df['ReservationUsedHours'].where(df['ReservationUsedHours'] > 0),
+    np.where(df['ReservationUsedCost'] != 0,
+      df['UsedCost'] / df['ReservationUsedCost'].where(df['ReservationUsedCost'] != 0), 1 / rows))
+  df['UnusedCost'] = df['ReservationUnusedCost'] * share
+  df['AmortizedCost'] = df['UsedCost'] + df['UnusedCost']
+  return df.drop(columns=['ReservationUsedHours', 'ReservationUsedCost', 'ReservationUnusedCost'])
+
+def read_vm_sku(file, csv_separator, csv_encoding):
+  """
+    Loads the table of Virtual Machines SKU indexed by SKU
+    Input:
+      - file: csv file with columns Sku, Family, vCPU, MemoryGB and PricePerHour
+      - csv_separator: separator of the csv file
+      - csv_encoding: encoding of the csv file
+    Output:
+      - pandas dataframe indexed by Sku
+  """
+  df_sku = pd.read_csv(file, sep=csv_separator, encoding=csv_encoding,
+    dtype={'Sku': 'str', 'Family': 'str', 'vCPU': 'int64', 'MemoryGB': 'float64', 'PricePerHour': 'float64'})
+  return df_sku.drop_duplicates(subset='Sku').set_index('Sku')
+
+def get_vm_usage(df):
+  """
+    Groups the Virtual Machines meters billed on demand by resource and SKU
+    and calculates the usage hours and the cost per day over the Daily window
+    Input:
+      - df: dataframe with AdditionalInfo already reduced to the SKU
+    Output:
+      - pandas dataframe with one row per resource and per SKU
+  """
+  window_days = ((df['Date'].max() - df['Date'].min()).days) + 1
+  filter = ((df['MeterCategory'] == 'Virtual Machines') & (df['ChargeType'] == 'Usage')
+    & (df['PricingModel'] == 'OnDemand') & (df['AdditionalInfo'] != ''))
+  df_vm = df.loc[filter].groupby(['SubscriptionName', 'ResourceGroup', 'ResourceName', 'AdditionalInfo'],
+    as_index=False, dropna=False).agg(UsageHours = ('Quantity', 'sum'), Cost = ('Cost', 'sum'))
+  df_vm.rename(columns={'AdditionalInfo': 'Sku'}, inplace=True)
+  df_vm['HoursPerDay'] = df_vm['UsageHours'] / window_days
+  df_vm['CostPerDay'] = df_vm['Cost'] / window_days
+  return df_vm
+
+def get_right_sizing(df_vm, df_sku):
+  """
+    Lists for each Virtual Machine the cheaper sizes in the same family
+    and the projected savings over a month of 30 days,
+    calculated on the actual cost of the Virtual Machine
+    Input:
+      - df_vm: dataframe returned by get_vm_usage
+      - df_sku: dataframe returned by read_vm_sku
+    Output:
+      - pandas dataframe with one row per Virtual Machine and per cheaper size, sorted by savings
+  """
+  # Retrieves family, size and price of the current SKU
+  df = df_vm.join(df_sku, on='Sku', how='inner')
+  # Joins with the SKU of the same family and keeps only the cheaper ones
+  df = df.merge(df_sku.reset_index(), on='Family', suffixes=('', 'Candidate'))
+  savings_per_day = df['CostPerDay'] * (1 - df['PricePerHourCandidate'] / df['PricePerHour'])
+  df = df.loc[df['PricePerHourCandidate'] < df['PricePerHour']].assign(
+    SavingsPerDay = savings_per_day, ProjectedSavings = savings_per_day * 30
+  )
+  return df.sort_values(by=['ProjectedSavings'], ascending=False)
+
 def set_finops_tags(df, finops_tags):
   """
     Creates new columns in dataframe corresponding to the FinOps Tags
@@ -430,12 +637,57 @@ def main():
   # Drops columns BillingAccountName, BillingProfileName, BillingCurrency
   df.drop(columns=['BillingAccountName', 'BillingProfileName', 'BillingCurrency'], inplace=True)
 
-  # Extracts SKU of VM in additionnalInfo column
-  df['AdditionalInfo'] = df['AdditionalInfo'].apply(get_sku, args=(parameters['additionalInfo'],))
-  
   # Extracts Reservation type in ProductOrderName
   df['ProductOrderName'] = df['ProductOrderName'].apply(get_reservation_type)
 
+  # Calculates utilization and amortized cost of reservations on the rows of the source month
+  # before AdditionalInfo is reduced to the SKU (it contains the normalization ratio of reservations)
+  df_reservation = get_reservation_rows(df, int(split_file[3]))
+  if len(df_reservation) == 0:
+    print (f'No reservation found in the file {source_file}.')
+  elif not is_amortized(df_reservation):
+    print (f'the file {source_file} is not from the amortized cost dataset. Impossible to calculate the amortized cost of reservations.')
+  else:
+    reservation_path = os.path.join(target_path, parameters['targetReservation'])
+    if not create_target_directory(reservation_path):
+      print('Error : Error during the creation of the target directory.')
+      exit(1)
+    for reservation_file in ['ReservationDaily', 'ReservationMonthly', 'ReservationResource']:
+      if not create_target_directory(os.path.join(reservation_path, reservation_file)):
+        print('Error : Error during the creation of the target directory.')
+        exit(1)
+    df_usage = get_reservation_usage(df_reservation)
+    df_daily = reservation_daily(df_usage)
+    df_daily.to_csv(os.path.join(reservation_path, 'ReservationDaily', re.sub('Detail', 'ReservationDaily', csv_source_file)),
+      sep=',', index=False)
+    reservation_monthly(df_daily).to_csv(
+      os.path.join(reservation_path, 'ReservationMonthly', re.sub('Detail', 'ReservationMonthly', csv_source_file)),
+      sep=',', index=False)
+    reservation_resources(df_usage, df_daily).to_csv(
+      os.path.join(reservation_path, 'ReservationResource', re.sub('Detail', 'ReservationResource', csv_source_file)),
+      sep=',', index=False)
+    del(df_usage, df_daily)
+  del(df_reservation)
+
+  # Extracts SKU of VM in additionnalInfo column
+  df['AdditionalInfo'] = df['AdditionalInfo'].apply(get_sku, args=(parameters['additionalInfo'],))
+
+  # if daily file, searches cheaper sizes of Virtual Machines in the same family
+  if not GROUPING:
+    sku_file = os.path.join(parameters['pathData'], parameters['vmSkuFile'])
+    if not os.path.isfile(sku_file):
+      print (f'the file {sku_file} was not found. Impossible to calculate the right sizing of Virtual Machines.')
+    else:
+      right_sizing_path = os.path.join(target_path, parameters['targetRightSizing'])
+      if not create_target_directory(right_sizing_path):
+        print('Error : Error during the creation of the target directory.')
+        exit(1)
+      df_sku = read_vm_sku(sku_file, parameters['csvSkuSeparator'], parameters['csvEncoding'])
+      df_right_sizing = get_right_sizing(get_vm_usage(df), df_sku).round({'HoursPerDay': 2})
+      df_right_sizing.to_csv(os.path.join(right_sizing_path, re.sub('Detail', 'RightSizing', csv_source_file)), sep=',', index=False)
+      del(df_sku, df_right_sizing)
+      cleaning_retention_files('RightSizing', parameters['retentionDay'], right_sizing_path, '.csv')
+
   # Adds FinOps Tags in df
   df = set_finops_tags(df, parameters['finopsTags'])
 
@@ -454,12 +706,29 @@ def main():
   for finops_tag in finops_tags:
     df[finops_tag] = df['Tags'].apply(set_finops_tag, args=(finops_tag,))
 
-  # Drops column 'Tags'
-  df.drop(columns=['Tags'], inplace=True)
+  # Drops columns 'Tags', 'Quantity', 'ReservationId' and 'UnitOfMeasure'
+  df.drop(columns=['Tags', 'Quantity', 'ReservationId', 'UnitOfMeasure'], inplace=True, errors='ignore')
 
   # Writes result file
   df.to_csv(target_file, sep=',', index=False)
-  
+
+  # Daily = writes a copy sorted by resource and date with the index of byte ranges per resource
+  if not GROUPING:
+    sorted_path = os.path.join(target_path, parameters['targetDailySorted'])
+    index_path = os.path.join(target_path, parameters['targetDailyIndex'])
+    for path in [sorted_path, index_path]:
+      if not create_target_directory(path):
+        print('Error : Error during the creation of the target directory.')
+        exit(1)
+    sorted_file = os.path.join(sorted_path, re.sub('Detail', 'DailySorted', csv_source_file))
+    index_file = os.path.join(index_path, re.sub('Detail', 'DailyIndex', csv_source_file))
+    # Removes the index of the previous run, its offsets do not match the new file
+    if os.path.isfile(index_file):
+      os.remove(index_file)
+    df.sort_values(by=['ResourceName', 'Date'], inplace=True, kind='stable')
+    df.to_csv(sorted_file, sep=',', index=False)
+    write_daily_index(sorted_file, df['ResourceName'], df['Date'].max(), index_file)
+
   # Cleaning files regarding retention declared in Json file
   # Monthly files
   path_to_remove = os.path.join(target_path, parameters['targetMonthly'])
@@ -467,6 +736,19 @@ def main():
   # Daily files
   path_to_remove = os.path.join(target_path, parameters['targetDaily'])
   cleaning_retention_files('Daily', parameters['retentionDay'], path_to_remove, '.csv')
+  # Reservation files
+  path_to_remove = os.path.join(target_path, parameters['targetReservation'])
+  if os.path.exists(path_to_remove):
+    cleaning_retention_files('ReservationDaily', parameters['retentionDay'], os.path.join(path_to_remove, 'ReservationDaily'), '.csv')
+    cleaning_retention_files('ReservationMonthly', parameters['retentionMonth'], os.path.join(path_to_remove, 'ReservationMonthly'), '.csv')
+    cleaning_retention_files('ReservationResource', parameters['retentionMonth'], os.path.join(path_to_remove, 'ReservationResource'), '.csv')
+  # Daily sorted and index files
+  path_to_remove = os.path.join(target_path, parameters['targetDailySorted'])
+  if os.path.exists(path_to_remove):
+    cleaning_retention_files('DailySorted', parameters['retentionDay'], path_to_remove, '.csv')
+  path_to_remove = os.path.join(target_path, parameters['targetDailyIndex'])
+  if os.path.exists(path_to_remove):
+    cleaning_retention_files('DailyIndex', parameters['retentionDay'], path_to_remove, '.csv')
   
   print(target_file)
   
@@ -476,4 +758,5 @@ def main():
   duration = calculate_duration(start, end)
   print (f'Script executed in {duration}')
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,156 @@
+"""
+  Name    : daily_index.py
+  Author  : Frederic Parmentier
+  Version : 1.0
+  Creation Date : 19/10/2026
+
+  Index of the DailySorted file written by Set-AzBillingSynthesis.py, sorted by ResourceName then Date.
+  The index gives for each resource the byte range of its rows, so the rows of a resource
+  are read without parsing the whole file.
+  The first line of the index keeps the size and the last date of the DailySorted file.
+
+  Usage: python daily_index.py <daily sorted file> <index file> <resource name> [number of last days]
+"""
+
+import pandas as pd
+import numpy as np
+import csv
+import io
+import mmap
+import os
+import re
+import sys
+import datetime
+
+# ---- Declares global constant ----
+NUMERIC_COLUMNS = ['Cost', 'UnitPrice', 'PayGPrice']
+
+
+# ---- Declares functions ----
+
+def get_daily_index(daily_file, resources):
+  """
+    Calculates for each resource the byte range of its rows in the Daily file.
+    The Daily file must be sorted by ResourceName then Date
+    Input:
+      - daily_file: Daily csv file written from the sorted dataframe
+      - resources: column ResourceName of the sorted dataframe
+    Output:
+      - pandas dataframe with columns ResourceName, Offset and Length
+      - None if the lines of the file do not match the rows (field with a new line)
+  """
+  names = resources.fillna('').to_numpy()
+  with open(daily_file, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0 or len(names) == 0:
+      return pd.DataFrame(columns=['ResourceName', 'Offset', 'Length'])
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      # End of each line, the first one being the header
+      ends = np.flatnonzero(np.frombuffer(mm, dtype=np.uint8) == ord('\n'))
+      file_size = len(mm)
+  # a quoted field containing a new line shifts the offsets of the following rows
+  if len(ends) != len(names) + 1:
+    print(f'Error : the file {daily_file} has {len(ends) - 1} lines for {len(names)} rows. Impossible to create the index.')
+    return None
+  starts = np.concatenate(([0], ends + 1))
+  # First row of each resource, then start of the next resource or end of file
+  first_rows = np.concatenate(([0], np.flatnonzero(names[1:] != names[:-1]) + 1))
+  offsets = starts[first_rows + 1]
+  next_offsets = np.append(offsets[1:], file_size)
+  df_index = pd.DataFrame({'ResourceName': names[first_rows], 'Offset': offsets, 'Length': next_offsets - offsets})
+  return df_index.loc[df_index['ResourceName'] != '']
+
+def write_daily_index(daily_file, resources, end_date, index_file):
+  """
+    Writes the index of the Daily file. The index is written in a temporary file then renamed,
+    and is removed if it cannot be created, so an index never describes another file
+    Input:
+      - daily_file: Daily csv file written from the sorted dataframe
+      - resources: column ResourceName of the sorted dataframe
+      - end_date: last date of the Daily file
+      - index_file: index file to write
+    Output:
+      - True if the index is written, False otherwise
+  """
+  df_index = get_daily_index(daily_file, resources)
+  if df_index is None:
+    if os.path.isfile(index_file):
+      os.remove(index_file)
+    return False
+  temp_file = index_file + '.tmp'
+  with open(temp_file, 'w', newline='') as f:
+    f.write(f'# FileSize={os.path.getsize(daily_file)} EndDate={pd.Timestamp(end_date):%Y-%m-%d}\n')
+    df_index.to_csv(f, sep=',', index=False)
+  os.replace(temp_file, index_file)
+  return True
+
+def query_daily_resource(daily_file, index_file, resource_name, days=None, end_date=None):
+  """
+    Reads in the Daily file only the rows of a resource, using the index file
+    Input:
+      - daily_file: Daily csv file sorted by ResourceName then Date
+      - index_file: index file written with write_daily_index
+      - resource_name: name of the resource to search
+      - days: number of last days of the Daily file to keep (all days if None)
+      - end_date: last day of the period (last date of the Daily file if None)
+    Output:
+      - pandas dataframe with the rows of the resource (empty if the resource is not found)
+      - raises ValueError if the index does not match the Daily file
+  """
+  offset = None
+  with open(index_file, newline='') as f:
+    metadata = re.search(r"^# FileSize=(\d+) EndDate=([\d-]+)", f.readline())
+    if not metadata:
+      raise ValueError(f'the file {index_file} is not an index of Daily file.')
+    reader = csv.reader(f, delimiter = ',')
+    next(reader)  # skip the header row
+    for row in reader:
+      if row[0] == resource_name:
+        offset, length = int(row[1]), int(row[2])
+        break
+  file_size = os.path.getsize(daily_file)
+  if file_size != int(metadata.group(1)):
+    raise ValueError(f'the file {index_file} does not match the file {daily_file}.')
+  if file_size == 0:
+    return pd.DataFrame()
+  if end_date is None:
+    end_date = metadata.group(2)
+  with open(daily_file, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      header = mm[:mm.find(b'\n') + 1]
+      rows = mm[offset:offset + length] if offset is not None else b''
+  df = pd.read_csv(io.BytesIO(header + rows), dtype='str')
+  if (df['ResourceName'] != resource_name).any():
+    raise ValueError(f'the file {index_file} does not match the rows of {resource_name} in {daily_file}.')
+  df['Date'] = pd.to_datetime(df['Date'])
+  for column in NUMERIC_COLUMNS:
+    if column in df.columns:
+      df[column] = pd.to_numeric(df[column])
+  if days is not None:
+    end_date = pd.Timestamp(end_date)
+    start_date = end_date - datetime.timedelta(days=days - 1)
+    df = df.loc[(df['Date'] >= start_date) & (df['Date'] <= end_date)]
+  return df
+#
+# ---- Main program ----
+def main():
+
+  if len(sys.argv) not in (4, 5):
+    print('Usage: python daily_index.py <daily sorted file> <index file> <resource name> [number of last days]')
+    exit(1)
+
+  daily_file, index_file, resource_name = sys.argv[1:4]
+  days = int(sys.argv[4]) if len(sys.argv) == 5 else None
+  for file in [daily_file, index_file]:
+    if not os.path.isfile(file):
+      print (f'the file {file} was not found.')
+      exit(1)
+
+  try:
+    df = query_daily_resource(daily_file, index_file, resource_name, days)
+  except ValueError as error:
+    print(f'Error : {error}')
+    exit(1)
+  df.to_csv(sys.stdout, sep=',', index=False)
+
+if __name__ == '__main__':
+  main()